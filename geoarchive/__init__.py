@@ -1,74 +1,301 @@
 import hashlib
+import json
+import mmap
+import os
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import ahocorasick
 import numpy as np
 import re
+from datetime import datetime
 from dateutil import parser
 
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# hashlib hands each update to OpenSSL, which already dispatches to SHA-NI where the CPU has it;
+# large chunks keep the per-call overhead from capping throughput
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+# Local cache for lookups that are expensive to rebuild (GeoKB query results, compiled term automata)
+CACHE_DIR = os.environ.get('GEOARCHIVE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'geoarchive'))
+
+# Vocabulary size up to which the optional Hyperscan backend is used for term matching
+HYPERSCAN_MAX_TERMS = 64
+
+# Vocabulary size from which compiled automata are kept on disk; smaller ones build faster than they load
+AUTOMATON_CACHE_MIN_TERMS = 1000
+
+DOCUMENT_SEPARATOR = '\x00'
+
+def _update_hashes(hashers: list, file):
+    # Mapping the file avoids copying it through a read buffer; empty files can't be mapped and very large files may not
+    # fit the address space on 32-bit builds, so those fall back to a chunked read into a reused buffer. Either way each
+    # chunk is fed to every hasher while it is still in cache, so several checksums cost a single pass over the file.
+    if os.fstat(file.fileno()).st_size > 0:
+        try:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm) as view:
+                    for offset in range(0, len(view), CHECKSUM_CHUNK_SIZE):
+                        chunk = view[offset:offset + CHECKSUM_CHUNK_SIZE]
+                        for h in hashers:
+                            h.update(chunk)
+                        chunk.release()
+            return
+        except (OSError, OverflowError, ValueError):
+            pass
+
+    buffer = bytearray(CHECKSUM_CHUNK_SIZE)
+    view = memoryview(buffer)
+    while size := file.readinto(buffer):
+        for h in hashers:
+            h.update(view[:size])
+
 def calculate_checksum(file_path: str, checksum_type: str = 'sha256'):
+    return _stat_and_checksums(file_path, (checksum_type,))[1][checksum_type]
+
+def checksum_sidecar_path(file_path: str):
+    return f'{file_path}.checksums.json'
+
+def _read_sidecar(sidecar_path: str, stat, checksum_types: tuple):
+    # A missing, stale, or unreadable sidecar (e.g. one cut short by a killed run) is just a cache miss
+    try:
+        with open(sidecar_path) as f:
+            sidecar = json.load(f)
+        if sidecar['size'] == stat.st_size and sidecar['mtime_ns'] == stat.st_mtime_ns:
+            return {t: sidecar['checksums'][t] for t in checksum_types}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+def _write_sidecar(sidecar_path: str, stat, checksums: dict):
+    # Written to a temporary file and moved into place so a reader never sees a partial sidecar; a directory that
+    # can't be written to just means the checksums aren't cached
+    try:
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(sidecar_path) or '.', delete=False) as f:
+            json.dump({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'checksums': checksums}, f)
+        os.replace(f.name, sidecar_path)
+    except OSError:
+        pass
+
+def _stat_and_checksums(file_path: str, checksum_types: tuple, use_sidecar: bool = False):
+    # With use_sidecar, checksums are kept in a JSON sidecar next to the file and reused for as long as the file's size
+    # and modification time are unchanged, so files kept in a cache between runs aren't rehashed. The size and the
+    # hashes come from the same open file handle.
+    sidecar_path = checksum_sidecar_path(file_path)
+
     with open(file_path, 'rb') as file:
-        if checksum_type == 'md5':
-            h = hashlib.md5()
-        elif checksum_type == 'sha256':
-            h = hashlib.sha256()
-        chunk = file.read(8192)
-        while chunk:
-            h.update(chunk)
-            chunk = file.read(8192)
-    return h.hexdigest()
+        stat = os.fstat(file.fileno())
 
-def extract_linkable_terms(documents: list, terms: dict):
-    A = ahocorasick.Automaton()
+        if use_sidecar:
+            checksums = _read_sidecar(sidecar_path, stat, checksum_types)
+            if checksums:
+                return stat.st_size, checksums
 
-    for idx, term in enumerate(terms.keys()):
-        A.add_word(term, (idx, term))
+        hashers = {checksum_type: hashlib.new(checksum_type) for checksum_type in checksum_types}
+        _update_hashes(list(hashers.values()), file)
+        checksums = {checksum_type: h.hexdigest() for checksum_type, h in hashers.items()}
+
+    if use_sidecar:
+        _write_sidecar(sidecar_path, stat, checksums)
+
+    return stat.st_size, checksums
+
+def stat_and_hash(file_path: str, use_sidecar: bool = False):
+    # Size, SHA-256, and MD5 of a file from a single open and pass; use_sidecar reuses and records them in a
+    # checksum sidecar next to the file
+    size, checksums = _stat_and_checksums(file_path, ('sha256', 'md5'), use_sidecar)
+    return size, checksums['sha256'], checksums['md5']
+
+def calculate_checksums(file_paths: list, checksum_type: str = 'sha256', max_workers: int = 8):
+    # hashlib releases the GIL while digesting, so independent files hash in parallel on separate threads
+    if not file_paths:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        checksums = executor.map(lambda file_path: calculate_checksum(file_path, checksum_type), file_paths)
+        return dict(zip(file_paths, checksums))
+
+def _join_documents(documents: list):
+    # Scanning one contiguous buffer avoids a pass (and a generator) per document; no term contains the NUL
+    # separator, so a match can never span two documents. Pages without text come through as None and are skipped.
+    return DOCUMENT_SEPARATOR.join(doc for doc in documents if doc)
+
+def _term_array(term_keys: frozenset):
+    # Terms are held in sorted order so that matches can be counted by integer index instead of by string, and so that
+    # the terms found (and the cached automata) come out the same whatever the process's hash seed
+    return np.array(sorted(term_keys), dtype=object)
+
+def _build_automaton(term_keys: frozenset):
+    # The payload is just the term's index stored as a C integer, so a match yields no tuple or string objects
+    term_array = _term_array(term_keys)
+    A = ahocorasick.Automaton(ahocorasick.STORE_INTS)
+
+    for idx, term in enumerate(term_array):
+        A.add_word(term, idx)
 
     A.make_automaton()
 
-    matches = {} 
-    for doc in documents:
-        for end_index, (idx, term) in A.iter(doc):
-            start_index = end_index - len(term) + 1
-            if term in matches:
-                matches[term] += 1
-            else:
-                matches[term] = 1
+    return A, term_array
 
-    frequencies = np.array(list(matches.values()))
-    mean_freq = np.mean(frequencies)
-    std_freq = np.std(frequencies)
+def _write_cache_file(cache_file: str, obj):
+    # Pickled to a temporary file and moved into place so a reader never sees a partial file
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_file), delete=False) as f:
+            tmp_path = f.name
+            pickle.dump(obj, f)
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-    z_scores = {term: (count - mean_freq) / std_freq for term, count in matches.items()}
+@lru_cache(maxsize=8)
+def _load_or_build_automaton(term_keys: frozenset):
+    # Keyed on the term vocabulary alone, so repeated calls with the same lookup (e.g. one per document in a batch)
+    # reuse the compiled trie instead of rebuilding it. Large vocabularies are also pickled to the cache directory so
+    # a new process can skip construction.
+    if len(term_keys) < AUTOMATON_CACHE_MIN_TERMS:
+        return _build_automaton(term_keys)
 
-    return {term: terms[term] for term, z in z_scores.items() if z > 2}
+    key = hashlib.sha256('\n'.join(sorted(term_keys)).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(CACHE_DIR, f'ac_{key}.pkl')
 
-def extract_date(document: str):
-    date_patterns = [
-        r'\b\d{4}-\d{2}-\d{2}\b',  # YYYY-MM-DD
-        r'\b\d{2}/\d{2}/\d{4}\b',  # MM/DD/YYYY
-        r'\b\d{2}-\d{2}-\d{4}\b',  # DD-MM-YYYY
-        r'\b\d{1,2} \w+ \d{4}\b',  # D Month YYYY or DD Month YYYY
-        r'\b\w+ \d{1,2}, \d{4}\b',  # Month D, YYYY or Month DD, YYYY
-        r'\b\d{1,2}(?:st|nd|rd|th)? \w+ \d{4}\b',  # D(th) Month YYYY or DD(th) Month YYYY
-        r'\b\w+ \d{1,2}(?:st|nd|rd|th)?, \d{4}\b'  # Month D(th), YYYY or Month DD(th), YYYY
-    ]
-
-    found_dates = []
-    for pattern in date_patterns:
-        matches = re.findall(pattern, document)
-        found_dates.extend(matches)
-
-    if found_dates:
-        found_dates = list(set(found_dates))
-
-        valid_dates = []
-        for date_str in found_dates:
-            try:
-                date_obj = parser.parse(date_str)
-                valid_dates.append(date_obj)
-            except ValueError:
-                continue
-
-        if valid_dates:
-            return max(valid_dates).isoformat()
-        else:
+    # As with checksum sidecars, a cache file that can't be read or written is just a miss
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+
+    A, term_array = _build_automaton(term_keys)
+    _write_cache_file(cache_file, (A, term_array))
+
+    return A, term_array
+
+@lru_cache(maxsize=8)
+def _build_hyperscan_db(term_keys: frozenset):
+    term_array = _term_array(term_keys)
+    db = hyperscan.Database()
+    db.compile(
+        expressions=[term.encode('utf-8') for term in term_array],
+        ids=list(range(len(term_array))),
+        elements=len(term_array),
+        literal=True
+    )
+
+    return db, term_array
+
+def _compact_counts(counts):
+    # Per-term counts fit in int32 for any realistic document; the wider type is kept only if one overflows
+    counts = np.asarray(counts)
+    if counts.max(initial=0) <= np.iinfo(np.int32).max:
+        return counts.astype(np.int32, copy=False)
+    return counts.astype(np.int64, copy=False)
+
+def _count_terms_hyperscan(documents: list, term_keys: frozenset):
+    db, term_array = _build_hyperscan_db(term_keys)
+
+    counts = [0] * len(term_array)
+    def on_match(idx, start, end, flags, context):
+        counts[idx] += 1
+
+    db.scan(_join_documents(documents).encode('utf-8'), match_event_handler=on_match)
+
+    return term_array, _compact_counts(counts)
+
+def _count_terms_automaton(documents: list, term_keys: frozenset):
+    A, term_array = _load_or_build_automaton(term_keys)
+
+    # fromiter grows its int32 buffer geometrically, and bincount tallies the indexes in a single C pass
+    hits = np.fromiter((idx for end_index, idx in A.iter(_join_documents(documents))), dtype=np.int32)
+    counts = np.bincount(hits, minlength=len(term_array))
+
+    return term_array, _compact_counts(counts)
+
+def extract_linkable_terms(documents: list, terms: dict):
+    term_keys = frozenset(terms)
+
+    # Small vocabularies fit Hyperscan's SIMD literal matcher (Teddy); anything larger stays on Aho-Corasick
+    if hyperscan is not None and len(term_keys) <= HYPERSCAN_MAX_TERMS:
+        term_array, counts = _count_terms_hyperscan(documents, term_keys)
+    else:
+        term_array, counts = _count_terms_automaton(documents, term_keys)
+
+    # Only terms that occur at all take part in the z-scores. With no matches or a flat distribution no term stands
+    # out (and the z-scores would be NaN).
+    found = counts > 0
+    if not found.any():
+        return {}
+
+    found_terms = term_array[found]
+    frequencies = counts[found]
+    std_freq = frequencies.std(ddof=0)
+    if std_freq == 0:
+        return {}
+
+    z_scores = (frequencies - frequencies.mean()) / std_freq
+
+    return {term: terms[term] for term in found_terms[z_scores > 2]}
+
+# Each kind of candidate is found with its own pattern, compiled once, so the kind tells us which fixed format to parse
+# it with. The kinds are scanned separately because their matches can overlap (e.g. "12 dated 2021" would hide the ISO
+# date in "No. 12 dated 2021-06-30" from a single alternation). The ordinal suffix is optional, so the word forms also
+# cover plain "D Month YYYY" and "Month D, YYYY".
+DATE_PATTERNS = {
+    'iso': r'\d{4}-\d{2}-\d{2}',  # YYYY-MM-DD
+    'slash': r'\d{2}/\d{2}/\d{4}',  # MM/DD/YYYY
+    'dash': r'\d{2}-\d{2}-\d{4}',  # DD-MM-YYYY
+    'day_month': r'\d{1,2}(?:st|nd|rd|th)? \w+ \d{4}',  # D(th) Month YYYY or DD(th) Month YYYY
+    'month_day': r'\w+ \d{1,2}(?:st|nd|rd|th)?, \d{4}'  # Month D(th), YYYY or Month DD(th), YYYY
+}
+DATE_RES = {name: re.compile(rf'\b{pattern}\b') for name, pattern in DATE_PATTERNS.items()}
+ORDINAL_SUFFIX_RE = re.compile(r'(?<=\d)(?:st|nd|rd|th)\b')
+
+# Formats tried in order for each kind of candidate. Numeric dates read month first and fall back to day first
+# when the month is out of range, which is how dateutil resolved them.
+DATE_FORMATS = {
+    'iso': ['%Y-%m-%d'],
+    'slash': ['%m/%d/%Y', '%d/%m/%Y'],
+    'dash': ['%m-%d-%Y', '%d-%m-%Y'],
+    'day_month': ['%d %B %Y', '%d %b %Y'],
+    'month_day': ['%B %d, %Y', '%b %d, %Y']
+}
+
+def _parse_date(kind: str, date_str: str):
+    if kind in ('day_month', 'month_day'):
+        date_str = ORDINAL_SUFFIX_RE.sub('', date_str)
+
+    for date_format in DATE_FORMATS[kind]:
+        try:
+            return datetime.strptime(date_str, date_format)
+        except ValueError:
+            continue
+
+    # Month names strptime doesn't know (e.g. "Sept") are left to dateutil's generic parser
+    if kind in ('day_month', 'month_day'):
+        try:
+            return parser.parse(date_str)
+        except (ValueError, OverflowError):
             return None
+
+def extract_date(document: str):
+    found_dates = {(kind, date_str) for kind, date_re in DATE_RES.items() for date_str in date_re.findall(document)}
+
+    # ISO strings sort in date order, so the latest ISO date is the first candidate from the top that parses
+    iso_dates = sorted((date_str for kind, date_str in found_dates if kind == 'iso'), reverse=True)
+    parsed_dates = [next(filter(None, (_parse_date('iso', date_str) for date_str in iso_dates)), None)]
+    parsed_dates.extend(_parse_date(kind, date_str) for kind, date_str in found_dates if kind != 'iso')
+
+    latest_date = max(filter(None, parsed_dates), default=None)
+
+    if latest_date:
+        return latest_date.isoformat()
+    else:
+        return None
@@ -1,6 +1,18 @@
 import os
+import hashlib
+import pickle
+import time
+import requests
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from wbmaker import WB
 
+from . import CACHE_DIR, _write_cache_file
+
+# Reference lookups change rarely; reuse query results for up to an hour
+SPARQL_CACHE_TTL = 3600
+
 class GeoKB:
     def __init__(self):
         self.check_env()
@@ -23,15 +35,72 @@ class GeoKB:
     def wb_session(self):
         self.wb = WB()
 
+    def sparql_records(self, query):
+        '''
+        Run a SPARQL query and return its results as a dataframe, raising if the query fails. wbmaker's sparql_query returns
+        None both for a failed request and for no results; lookups that decide whether to create a new item need to know
+        which, since a failed lookup taken as "not found" would create a duplicate.
+        '''
+        r = requests.get(os.environ['WB_SPARQL_ENDPOINT'], params={'format': 'json', 'query': query})
+        r.raise_for_status()
+        results = r.json()
+
+        return pd.DataFrame(
+            [{var: binding[var]['value'] if var in binding else None for var in results['head']['vars']} for binding in results['results']['bindings']],
+            columns=results['head']['vars']
+        )
+
 class Ref:
-    def __init__(self, geokb_con=None):
+    def __init__(self, geokb_con=None, cache_ttl=SPARQL_CACHE_TTL):
         if geokb_con:
             self.geokb_con = geokb_con
         else:
             self.geokb_con = GeoKB()
 
-        self.geokb_commodities()
-        self.geokb_places()
+        self.cache_ttl = cache_ttl
+
+        # Item indexes for Entity are full-table queries, so they are only run if an Entity asks for them
+        self._archived_at_lookup = None
+        self._sedar_lookup = None
+
+        # The reference queries are independent, so we wait on both round-trips together rather than in turn
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            lookups = [
+                executor.submit(self.geokb_commodities),
+                executor.submit(self.geokb_places)
+            ]
+            for lookup in lookups:
+                lookup.result()
+
+    def sparql_query(self, query):
+        '''
+        Run a SPARQL query against the GeoKB, reusing the result cached on disk if it is younger than cache_ttl seconds.
+        Failed or empty queries (None from the endpoint) are never cached.
+        '''
+        cache_file = os.path.join(CACHE_DIR, f"sparql_{hashlib.sha256(query.encode('utf-8')).hexdigest()}.pkl")
+
+        # A cache file that is missing, stale, or can't be read is a miss, and one that can't be written is skipped
+        if self.cache_ttl:
+            try:
+                if time.time() - os.path.getmtime(cache_file) < self.cache_ttl:
+                    with open(cache_file, 'rb') as f:
+                        return pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                pass
+
+        df = self.geokb_con.wb.sparql_query(query)
+
+        if self.cache_ttl and df is not None:
+            _write_cache_file(cache_file, df)
+
+        return df
+
+    @staticmethod
+    def qid_lookup(df, key_column):
+        '''
+        Build a dictionary from a query result column to the QID of the item in each row.
+        '''
+        return dict(zip(df[key_column], df['item'].str.split('/').str[-1]))
 
     def geokb_commodities(self):
         q = """
@@ -45,10 +114,9 @@ class Ref:
         }
         """
 
-        df = self.geokb_con.wb.sparql_query(q)
-        df['itemLabel'] = df['itemLabel'].str.lower()
-        
-        self.commodity_lookup = df.set_index('itemLabel')['item'].to_dict()
+        df = self.sparql_query(q)
+
+        self.commodity_lookup = dict(zip(df['itemLabel'].str.lower(), df['item']))
 
     def geokb_places(self):
         q = """
@@ -63,70 +131,149 @@ class Ref:
         }
         """
 
-        df = self.geokb_con.wb.sparql_query(q)
-        
-        self.place_lookup = df.set_index('itemLabel')['item'].to_dict()
+        df = self.sparql_query(q)
+
+        self.place_lookup = dict(zip(df['itemLabel'], df['item']))
+
+    @property
+    def archived_at_lookup(self):
+        if self._archived_at_lookup is None:
+            self.geokb_archived_items()
+        return self._archived_at_lookup
+
+    @property
+    def sedar_lookup(self):
+        if self._sedar_lookup is None:
+            self.geokb_companies()
+        return self._sedar_lookup
+
+    def geokb_archived_items(self):
+        '''
+        Index existing GeoKB items by their archived at URL so that Entity can find the item for a document without a
+        query per document. New items are created as documents are processed, so this comes straight from the endpoint
+        rather than the disk cache and Entity keeps it current as it writes. It is built the first time archived_at_lookup
+        is read; a failed query raises and leaves the index to be built on the next read.
+        '''
+        q = f"""
+        PREFIX wdt: <https://geokb.wikibase.cloud/prop/direct/>
+
+        SELECT ?item ?archived_at
+        WHERE {{
+            ?item wdt:{self.geokb_con.wb.props['archivedAt']['property']} ?archived_at .
+        }}
+        """
+
+        df = self.geokb_con.sparql_records(q)
+
+        self._archived_at_lookup = self.qid_lookup(df, 'archived_at')
+
+    def geokb_companies(self):
+        '''
+        Index existing company items by SEDAR company identifier, on the same terms as geokb_archived_items.
+        '''
+        q = f"""
+        PREFIX wdt: <https://geokb.wikibase.cloud/prop/direct/>
+
+        SELECT ?item ?company_id
+        WHERE {{
+            ?item wdt:{self.geokb_con.wb.props['SEDAR company identifier']['property']} ?company_id .
+        }}
+        """
+
+        df = self.geokb_con.sparql_records(q)
+
+        self._sedar_lookup = self.qid_lookup(df, 'company_id')
 
 class Entity:
-    def __init__(self, schema_doc, geokb_con=None):
+    def __init__(self, schema_doc, geokb_con=None, geokb_ref=None):
         self.schema_doc = schema_doc
+        self.geokb_ref = geokb_ref
 
         if geokb_con:
             self.geokb_con = geokb_con
+        elif geokb_ref:
+            self.geokb_con = geokb_ref.geokb_con
         else:
             self.geokb_con = GeoKB()
 
+        self.index_schema_doc()
+        self.get_elements()
         self.add_or_update_company()
         self.get_item()
         self.entity_from_schema()
         self.write_entity()
 
+    def index_schema_doc(self):
+        '''
+        Index the schema document's identifiers by name and its about objects by type in one pass each, so the
+        workflow steps look them up directly instead of rescanning the lists. The first identifier with a given name
+        wins, as it did with the linear scans.
+        '''
+        self._ids = {}
+        for identifier in self.schema_doc['identifier']:
+            self._ids.setdefault(identifier['name'], identifier)
+
+        self._about_by_type = defaultdict(list)
+        for about_obj in self.schema_doc['about']:
+            self._about_by_type[about_obj['additional_type']].append(about_obj)
+
     def get_elements(self):
-        self.archived_at = next((i['url'] for i in self.schema_doc['identifier'] if i['name'] == 'ScienceBase Item ID'), None)
+        self.archived_at = self._ids.get('ScienceBase Item ID', {}).get('url')
         if self.archived_at is None:
             raise ValueError('No ScienceBase Item ID found in the schema document')
         
-        self.metadata_url = next((i['url'] for i in self.schema_doc['identifier'] if i['name'] == 'Zotero Key'), None)
+        # Documents published through NI43101Process carry their Zotero item URL as the document url
+        self.metadata_url = self._ids.get('Zotero Key', {}).get('url', self.schema_doc.get('url'))
         if self.metadata_url is None:
             raise ValueError('No Zotero Key/metadata URL found in the schema document')
 
     def get_item(self):
-        q = f"""
-        PREFIX wdt: <https://geokb.wikibase.cloud/prop/direct/>
+        if self.geokb_ref:
+            qid = self.geokb_ref.archived_at_lookup.get(self.archived_at)
+        else:
+            q = f"""
+            PREFIX wdt: <https://geokb.wikibase.cloud/prop/direct/>
 
-        SELECT ?item
-        WHERE {{
-            ?item wdt:{self.geokb_con.wb.props['archived at']['property']} ?archived_at .
-            FILTER(STR(?archived_at) = "{self.archived_at}")
-        }}
-        """
+            SELECT ?item
+            WHERE {{
+                ?item wdt:{self.geokb_con.wb.props['archivedAt']['property']} ?archived_at .
+                FILTER(STR(?archived_at) = "{self.archived_at}")
+            }}
+            """
 
-        df = self.geokb_con.wb.sparql_query(q)
-        if df.empty:
+            df = self.geokb_con.sparql_records(q)
+            qid = None if df.empty else df['item'].values[0].split('/')[-1]
+
+        if qid is None:
             self.item = self.geokb_con.wb.wbi.item.new()
             self.write_summary = 'created new NI 43-101 entity from schema.org source document'
         else:
-            self.item = self.geokb_con.wb.wbi.item.get(df['item'].values[0].split('/')[-1])
+            self.item = self.geokb_con.wb.wbi.item.get(qid)
             self.write_summary = 'updated NI 43-101 entity from schema.org source document'
 
     def add_or_update_company(self):
-        company_obj = next((i for i in self.schema_doc['about'] if i['additional_type'] == 'company'), None)
+        company_obj = next(iter(self._about_by_type['company']), None)
         if company_obj is None:
             self.company_item = None
             return
 
-        q = f"""
-        PREFIX wdt: <https://geokb.wikibase.cloud/prop/direct/>
+        if self.geokb_ref:
+            qid = self.geokb_ref.sedar_lookup.get(company_obj['identifier']['value'])
+        else:
+            q = f"""
+            PREFIX wdt: <https://geokb.wikibase.cloud/prop/direct/>
 
-        SELECT ?item
-        WHERE {{
-            ?item wdt:{self.geokb_con.wb.props['SEDAR company identifier']['property']} ?company_id .
-            FILTER(STR(?company_id) = "{company_obj['identifier']['value']}")
-        }}
-        """
+            SELECT ?item
+            WHERE {{
+                ?item wdt:{self.geokb_con.wb.props['SEDAR company identifier']['property']} ?company_id .
+                FILTER(STR(?company_id) = "{company_obj['identifier']['value']}")
+            }}
+            """
+
+            df = self.geokb_con.sparql_records(q)
+            qid = None if df.empty else df['item'].values[0].split('/')[-1]
 
-        df = self.geokb_con.wb.sparql_query(q)
-        if df.empty:
+        if qid is None:
             self.company_item = self.geokb_con.wb.wbi.item.new()
             self.company_item.labels.set('en', company_obj['name'])
             self.company_item.descriptions.set('en', 'commercial company involved in mineral exploration and development that posts securities filings in Canada')
@@ -149,124 +296,103 @@ class Entity:
             )
 
             self.company_item = self.company_item.write(summary='created new company entity referenced in NI 43-101 filing')
+
+            if self.geokb_ref:
+                self.geokb_ref.sedar_lookup[company_obj['identifier']['value']] = self.company_item.id
         else:
-            self.company_item = self.geokb_con.wb.wbi.item.get(df['item'].values[0].split('/')[-1])
+            self.company_item = self.geokb_con.wb.wbi.item.get(qid)
 
     def entity_from_schema(self):
         self.item.labels.set('en', self.schema_doc['name'])
         self.item.descriptions.set('en', self.schema_doc['abstract'])
 
-        self.item.claims.add(
-            self.geokb_con.datatypes.Item(
-                prop_nr=self.geokb_con.wbi.props['instance of']['property'],
-                value='Q10'
-            ),
-            action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL
-        )
+        datatypes = self.geokb_con.wb.datatypes
+        props = self.geokb_con.wb.props
+        replace_all = self.geokb_con.wb.wbi_enums.ActionIfExists.REPLACE_ALL
+        mime_type_prop = props['MIME type']['property']
 
-        sedar_filing_identifier = next((i['value'] for i in self.schema_doc['identifier'] if i['name'] == 'SEDAR filing identifier'), None)
-        self.item.claims.add(
-            self.geokb_con.datatypes.ExternalID(
-                prop_nr=self.geokb_con.wbi.props['SEDAR filing identifier']['property'],
-                value=sedar_filing_identifier
+        # All statements go onto the item in one add, so the replace-all pass over existing claims runs once
+        claims = [
+            datatypes.Item(
+                prop_nr=props['instance of']['property'],
+                value='Q10'
             ),
-            action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL
-        )
+            datatypes.ExternalID(
+                prop_nr=props['SEDAR filing identifier']['property'],
+                value=self._ids.get('SEDAR filing identifier', {}).get('value')
+            )
+        ]
 
         if self.company_item:
-            self.item.claims.add(
-                self.geokb_con.datatypes.Item(
-                    prop_nr=self.geokb_con.wbi.props['owner']['property'],
+            claims.append(
+                datatypes.Item(
+                    prop_nr=props['owner']['property'],
                     value=self.company_item.id
-                ),
-                action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL
+                )
             )
 
-        self.item.claims.add(
-            self.geokb_con.datatypes.URL(
-                prop_nr=self.geokb_con.wbi.props['metadata URL']['property'],
+        claims.append(
+            datatypes.URL(
+                prop_nr=props['metadata URL']['property'],
                 value=self.schema_doc['url'],
                 qualifiers=[
-                    self.geokb_con.datatypes.String(
-                        prop_nr=self.geokb_con.wbi.props['MIME type']['property'],
-                        value='text/html'
-                    ),
-                    self.geokb_con.datatypes.String(
-                        prop_nr=self.geokb_con.wbi.props['MIME type']['property'],
-                        value='application/json'
-                    )
+                    datatypes.String(prop_nr=mime_type_prop, value='text/html'),
+                    datatypes.String(prop_nr=mime_type_prop, value='application/json')
                 ]
-            ), action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL
+            )
         )
 
-        sb_archive_url = next((i['url'] for i in self.schema_doc['identifier'] if i['name'] == 'ScienceBase Item ID'), None)
-        self.item.claims.add(
-            self.geokb_con.datatypes.URL(
-                prop_nr=self.geokb_con.wbi.props['archivedAt']['property'],
-                value=sb_archive_url,
+        claims.append(
+            datatypes.URL(
+                prop_nr=props['archivedAt']['property'],
+                value=self._ids.get('ScienceBase Item ID', {}).get('url'),
                 qualifiers=[
-                    self.geokb_con.datatypes.String(
-                        prop_nr=self.geokb_con.wbi.props['MIME type']['property'],
-                        value='text/html'
-                    ),
-                    self.geokb_con.datatypes.String(
-                        prop_nr=self.geokb_con.wbi.props['MIME type']['property'],
-                        value='application/json'
-                    )
+                    datatypes.String(prop_nr=mime_type_prop, value='text/html'),
+                    datatypes.String(prop_nr=mime_type_prop, value='application/json')
                 ]
-            ), action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL
+            )
         )
 
-        content_url_claims = []
+        content_url_prop = props['content URL']['property']
+        sha256_prop = props['sha256']['property']
+        data_size_prop = props['data size']['property']
+        access_restricted_prop = props['access restricted to']['property']
         for media_obj in self.schema_doc['associatedMedia']:
-            content_url_claims.append(
-                self.geokb_con.datatypes.URL(
-                    prop_nr=self.geokb_con.wbi.props['content URL']['property'],
+            claims.append(
+                datatypes.URL(
+                    prop_nr=content_url_prop,
                     value=media_obj['url'],
                     qualifiers=[
-                        self.geokb_con.datatypes.String(
-                            prop_nr=self.geokb_con.wbi.props['MIME type']['property'],
-                            value=media_obj['encodingFormat']
-                        ),
-                        self.geokb_con.datatypes.String(
-                            prop_nr=self.geokb_con.wbi.props['sha256']['property'],
-                            value=media_obj['sha256']
-                        ),
-                        self.geokb_con.datatypes.Quantity(
-                            prop_nr=self.geokb_con.wbi.props['data size']['property'],
-                            amount=media_obj['contentSize'],
-                        ),
-                        self.geokb_con.datatypes.Item(
-                            prop_nr=self.geokb_con.wbi.props['access restricted to']['property'],
-                            value='Q44210'
-                        )
+                        datatypes.String(prop_nr=mime_type_prop, value=media_obj['encodingFormat']),
+                        datatypes.String(prop_nr=sha256_prop, value=media_obj['sha256']),
+                        datatypes.Quantity(prop_nr=data_size_prop, amount=media_obj['contentSize']),
+                        datatypes.Item(prop_nr=access_restricted_prop, value='Q44210')
                     ]
                 )
             )
-        self.item.claims.add(content_url_claims, action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL)
 
-        addresses_place_claims = []
+        addresses_place_prop = props['addresses place']['property']
         for loc_obj in self.schema_doc['spatialCoverage']:
-            addresses_place_claims.append(
-                self.geokb_con.datatypes.Item(
-                    prop_nr=self.geokb_con.wbi.props['addresses place']['property'],
+            claims.append(
+                datatypes.Item(
+                    prop_nr=addresses_place_prop,
                     value=loc_obj['identifier']['value']
                 )
             )
-        if addresses_place_claims:
-            self.item.claims.add(addresses_place_claims, action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL)
-
-        addresses_subject_claims = []
-        for subj in self.schema_doc['about']:
-            if subj['additional_type'] == 'commodity':
-                addresses_place_claims.append(
-                    self.geokb_con.datatypes.Item(
-                        prop_nr=self.geokb_con.wbi.props['addresses subject']['property'],
-                        value=subj['identifier']['value']
-                    )
+
+        addresses_subject_prop = props['addresses subject']['property']
+        for subj in self._about_by_type['commodity']:
+            claims.append(
+                datatypes.Item(
+                    prop_nr=addresses_subject_prop,
+                    value=subj['identifier']['value']
                 )
-        if addresses_subject_claims:
-            self.item.claims.add(addresses_subject_claims, action_if_exists=self.geokb_con.wbi_enums.ActionIfExists.REPLACE_ALL)
+            )
+
+        self.item.claims.add(claims, action_if_exists=replace_all)
 
     def write_entity(self):
-        self.item = self.item.write(summary=self.write_summary)
\ No newline at end of file
+        self.item = self.item.write(summary=self.write_summary)
+
+        if self.geokb_ref:
+            self.geokb_ref.archived_at_lookup[self.archived_at] = self.item.id
@@ -1,15 +1,109 @@
 import os
 from sciencebasepy import SbSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
 from datetime import datetime
 import pandas as pd
 import warnings
+import io
 import json
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-from . import calculate_checksum, extract_linkable_terms, extract_date
+from . import stat_and_hash, checksum_sidecar_path, extract_linkable_terms, extract_date
 from . import geokb
 from . import zotero
 
+# Parenthetical in a company's qualified name, which often records a former name
+COMPANY_PAREN_RE = re.compile(r'\((.*?)\)')
+
+def sb_session():
+    '''
+    Open an authenticated ScienceBase session.
+    The sb_token here is tied to an individual user account and is the only supported method of authenticating with ScienceBase
+    to access a secure collection.
+    '''
+    sb_token = {
+        "access_token": os.environ['SB_ACCESS_TOKEN'], 
+        "refresh_token": os.environ['SB_REFRESH_TOKEN']
+    }
+    sb = SbSession()
+    sb.add_token(sb_token)
+
+    # Each file makes several ScienceBase calls in a row; keep connections alive across them and retry transient gateway
+    # errors (urllib3 only re-sends idempotent methods, so uploads are never duplicated)
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504))
+    )
+    sb._session.mount('http://', adapter)
+    sb._session.mount('https://', adapter)
+
+    if not sb.is_logged_in():
+        raise ValueError("FAILED TO AUTHENTICATE TO ScienceBase")
+
+    return sb
+
+# State for each process_files worker process, set up once by _init_worker
+_worker = {}
+
+def _init_worker(cache_path, place_lookup, commodity_lookup, ni43101_file_archive_item_id, pdf_engine, page_workers, sb_login=True):
+    # Sessions can't be pickled across to the worker processes, so each worker that talks to ScienceBase authenticates its own
+    _worker['sb'] = sb_session() if sb_login else None
+    _worker['cache_path'] = cache_path
+    _worker['place_lookup'] = place_lookup
+    _worker['commodity_lookup'] = commodity_lookup
+    _worker['ni43101_file_archive_item_id'] = ni43101_file_archive_item_id
+    _worker['pdf_engine'] = pdf_engine
+    _worker['page_workers'] = page_workers
+
+def _pdfminer_page_texts(source_file_path, page_numbers=None):
+    # Text of each page (zero-based page_numbers, or all pages), None where a page has no text. pdfminer's TextConverter
+    # writes each analyzed page straight into a reused buffer, so the layout tree isn't walked again in Python to collect text.
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+
+    output = io.StringIO()
+    resource_manager = PDFResourceManager()
+    device = TextConverter(resource_manager, output, laparams=LAParams())
+    interpreter = PDFPageInterpreter(resource_manager, device)
+
+    page_texts = []
+    with open(source_file_path, 'rb') as fp:
+        for page in PDFPage.get_pages(fp, pagenos=page_numbers):
+            output.seek(0)
+            output.truncate()
+            interpreter.process_page(page)
+            page_text = output.getvalue().rstrip('\f')
+            page_texts.append(page_text if page_text.strip() else None)
+
+    device.close()
+
+    return page_texts
+
+def _pdfminer_page_count(source_file_path):
+    from pdfminer.pdfpage import PDFPage
+
+    with open(source_file_path, 'rb') as fp:
+        return sum(1 for _ in PDFPage.get_pages(fp))
+
+def dropbox_file_id(sb_file_meta):
+    # The dropbox file's own ScienceBase identifier, which names its local copy in the cache path
+    return sb_file_meta['url'].split('%2F')[-1]
+
+def _process_file(sb_file_meta):
+    archive_item = NI43101Item(sb_file_meta=sb_file_meta, **_worker)
+    return archive_item.schema_doc, archive_item.sb_item, archive_item.sedar_filing_id
+
+def _build_file(sb_file_meta):
+    # Everything up to the ScienceBase upload, which is left to the caller
+    return NI43101Item(sb_file_meta=sb_file_meta, upload=False, **_worker)
+
 class NI43101Process:
     '''
     This is a specific class with rules and processing for the NI 43-101 Technical Reports.
@@ -22,7 +116,8 @@ class NI43101Process:
             ni43101_dropbox_item_id = "66185a07d34e7eb9eb7d7b80",
             zotero_library_id = "4530692",
             cache_path = "/tmp",
-            pdf_engine='pdfminer'
+            pdf_engine='pymupdf',
+            page_workers=1
         ):
 
         self.ni43101_file_archive_item_id = ni43101_file_archive_item_id
@@ -30,6 +125,7 @@ class NI43101Process:
         self.zotero_library_id = zotero_library_id
         self.cache_path = cache_path
         self.pdf_engine = pdf_engine
+        self.page_workers = page_workers
 
         self.check_env()
         self.sb_session()
@@ -38,10 +134,15 @@ class NI43101Process:
         try:
             self.geokb = geokb.GeoKB()
             self.geokb_ref = geokb.Ref(geokb_con=self.geokb)
+            # Plain snapshots of the reference lookups are what each archive item (and worker process) works from
+            self.place_lookup = dict(self.geokb_ref.place_lookup)
+            self.commodity_lookup = dict(self.geokb_ref.commodity_lookup)
         except Exception as e:
             warnings.warn(f"Failed to initialize GeoKB. Schema will be generated without GeoKB linkages.")
             self.geokb = None
             self.geokb_ref = None
+            self.place_lookup = None
+            self.commodity_lookup = None
 
     def check_env(self):
         '''
@@ -59,18 +160,8 @@ class NI43101Process:
     def sb_session(self):
         '''
         Initialize the ScienceBase session.
-        The sb_token here is tied to an individual user account and is the only supported method of authenticating with ScienceBase
-        to access a secure collection.
         '''
-        sb_token = {
-            "access_token": os.environ['SB_ACCESS_TOKEN'], 
-            "refresh_token": os.environ['SB_REFRESH_TOKEN']
-        }
-        self.sb = SbSession()
-        self.sb.add_token(sb_token)
-
-        if not self.sb.is_logged_in():
-            raise ValueError("FAILED TO AUTHENTICATE TO ScienceBase")
+        self.sb = sb_session()
 
     def get_dropbox(self):
         '''
@@ -83,7 +174,7 @@ class NI43101Process:
         if 'files' not in self.dropbox_item or len(self.dropbox_item['files']) == 0:
             raise ValueError("No files found in the Dropbox item")
         
-    def process_files(self):
+    def process_files(self, max_workers=None):
         '''
         This function runs the workflow/pipeline to process each file in the dropbox item.
         The resulting archive_item object from invoking the NI43101Item class produces all of the following:
@@ -92,36 +183,201 @@ class NI43101Process:
         - A JSON file with the schema document
         - A new ScienceBase item JSON structure to house the files associated with the filing
         - The returned ScienceBase Item for further actions
+
+        Files are independent of each other and PDF parsing is CPU-bound, so each file is built in a separate worker process
+        (one fewer than the number of CPUs by default). Only a couple of files per worker are in flight at once so that downloaded
+        PDFs don't pile up in the cache path. Finished files are then published here in batches the size of a Zotero create call,
+        so each batch needs a single request to Zotero.
+
+        A file that fails doesn't stop the others. Its error is collected, and every file built up to that point (and any still
+        running in the pool) is published all the same. Failures are reported as warnings and returned as a dictionary of
+        exceptions keyed by the dropbox file name, or by SEDAR filing ID for files that failed while being published.
+        '''
+        if max_workers is None:
+            max_workers = self.default_max_workers()
+
+        files = iter(self.dropbox_item['files'])
+        max_pending = max_workers * 2
+
+        failures = {}
+        processed = []
+
+        def collect(future, f):
+            try:
+                processed.append(future.result())
+            except Exception as e:
+                failures[f['name']] = e
+
+        with self.worker_pool(max_workers) as executor:
+            pending = {}
+            try:
+                while True:
+                    for f in files:
+                        # Build the ScienceBase archive item
+                        pending[executor.submit(_process_file, f)] = f
+                        if len(pending) >= max_pending:
+                            break
+
+                    if not pending:
+                        break
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        collect(future, pending.pop(future))
+
+                    if len(processed) >= zotero.CREATE_BATCH_SIZE:
+                        batch, processed = processed, []
+                        failures.update(self.publish_items(batch))
+            finally:
+                # Files already handed to the pool are uploaded regardless, so they are published even if the run is cut short
+                for future, f in pending.items():
+                    collect(future, f)
+                if processed:
+                    batch, processed = processed, []
+                    failures.update(self.publish_items(batch))
+
+        for name, e in failures.items():
+            warnings.warn(f"Failed to process {name}: {e}")
+
+        return failures
+
+    async def process_files_async(self, max_workers=None, max_downloads=8, max_uploads=4):
         '''
-        for f in self.dropbox_item['files']:
-            # Build the ScienceBase archive item
-            archive_item = NI43101Item(
-                sb=self.sb,
-                cache_path=self.cache_path,
-                sb_file_meta=f, 
-                geokb_ref=self.geokb_ref,
-                ni43101_file_archive_item_id=self.ni43101_file_archive_item_id
+        Run the same workflow as process_files as a pipeline of three stages per file: the dropbox PDF is downloaded (up to max_downloads
+        at a time), the archive item is built by the worker processes, and the item's files are uploaded and the item published on its own
+        (up to max_uploads at a time). Each stage is limited separately, so workers stay busy parsing while other files are downloading
+        or uploading. The number of files in flight is bounded as in process_files.
+
+        Network calls run on a pool of max_downloads + max_uploads threads, each with its own authenticated ScienceBase session.
+        sciencebasepy refreshes the access token and rewrites the session headers inside each call, and neither SbSession nor
+        requests.Session is safe to share across threads, so sessions aren't shared; the pool size bounds how many are opened.
+        The worker processes only parse and don't log in to ScienceBase themselves. As in process_files, a file that fails doesn't
+        stop the others; failures are reported as warnings and returned as a dictionary of exceptions keyed by dropbox file name
+        or SEDAR filing ID.
+        '''
+        if max_workers is None:
+            max_workers = self.default_max_workers()
+
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(max_workers * 2)
+        downloads = asyncio.Semaphore(max_downloads)
+        uploads = asyncio.Semaphore(max_uploads)
+
+        thread_sessions = threading.local()
+        def thread_sb():
+            if not hasattr(thread_sessions, 'sb'):
+                thread_sessions.sb = sb_session()
+            return thread_sessions.sb
+
+        def download(f):
+            self.download_file(f, sb=thread_sb())
+
+        def upload_and_publish(archive_item):
+            archive_item.sb = thread_sb()
+            archive_item.upsert_sb()
+            return self.publish_items(
+                [(archive_item.schema_doc, archive_item.sb_item, archive_item.sedar_filing_id)],
+                sb=archive_item.sb
             )
 
-            # Create a Zotero item from the schema document
-            zotero_item = zotero.Zot(
-                library_id=self.zotero_library_id,
-                schema_doc=archive_item.schema_doc
+        files = self.dropbox_item['files']
+        executor = self.worker_pool(max_workers, sb_login=False)
+        io_executor = ThreadPoolExecutor(max_workers=max_downloads + max_uploads)
+
+        async def process_file(f):
+            async with in_flight:
+                async with downloads:
+                    await loop.run_in_executor(io_executor, download, f)
+
+                # Build the ScienceBase archive item; the PDF is already in the cache path so the worker won't fetch it again
+                archive_item = await loop.run_in_executor(executor, _build_file, f)
+
+                async with uploads:
+                    return await loop.run_in_executor(io_executor, upload_and_publish, archive_item)
+
+        try:
+            results = await asyncio.gather(*(process_file(f) for f in files), return_exceptions=True)
+        finally:
+            # Shutting down waits on the workers, which would block the event loop if done on it
+            await asyncio.to_thread(executor.shutdown)
+            await asyncio.to_thread(io_executor.shutdown)
+
+        failures = {}
+        for f, result in zip(files, results):
+            if isinstance(result, BaseException):
+                failures[f['name']] = result
+            else:
+                failures.update(result)
+
+        for name, e in failures.items():
+            warnings.warn(f"Failed to process {name}: {e}")
+
+        return failures
+
+    def default_max_workers(self):
+        # Leave a CPU free for the main process, which handles the network calls
+        return max((os.cpu_count() or 2) - 1, 1)
+
+    def worker_pool(self, max_workers, sb_login=True):
+        '''
+        Process pool for building archive items, with each worker set up to run NI43101Item on its own.
+        Workers only need their own ScienceBase session (sb_login) if they download and upload files themselves.
+        '''
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(self.cache_path, self.place_lookup, self.commodity_lookup, self.ni43101_file_archive_item_id, self.pdf_engine, self.page_workers, sb_login)
+        )
+
+    def download_file(self, sb_file_meta, sb=None):
+        '''
+        Download a dropbox file to the cache path under the name NI43101Item expects, unless it is already there.
+        The process's own ScienceBase session is used unless another one (sb) is given.
+        '''
+        local_file_name = f"{dropbox_file_id(sb_file_meta)}.pdf"
+        if not os.path.exists(os.path.join(self.cache_path, local_file_name)):
+            (sb or self.sb).download_file(
+                url=sb_file_meta['url'],
+                local_filename=local_file_name,
+                destination=self.cache_path
             )
 
+    def publish_items(self, processed, sb=None):
+        '''
+        Create the Zotero items for processed files, given as (schema_doc, sb_item, sedar_filing_id) tuples, and link each one from
+        its file's ScienceBase item and schema document. The Zotero items are created together in batched calls.
+        Each file is published on its own terms: files whose Zotero item or ScienceBase update fails are skipped and returned as a
+        dictionary of exceptions keyed by SEDAR filing ID. ScienceBase updates go through sb if given, or the process's own session.
+        '''
+        sb = sb or self.sb
+        failures = {}
+
+        # Create Zotero items from the schema documents
+        files_by_zotero_item = {}
+        for schema_doc, sb_item, sedar_filing_id in processed:
+            try:
+                zotero_item = zotero.Zot(
+                    library_id=self.zotero_library_id,
+                    schema_doc=schema_doc
+                )
+            except Exception as e:
+                failures[sedar_filing_id] = e
+                continue
+            files_by_zotero_item[zotero_item] = (sb_item, sedar_filing_id)
+
+        created, failed = zotero.commit_items(list(files_by_zotero_item))
+        for zotero_item, e in failed:
+            failures[files_by_zotero_item[zotero_item][1]] = e
+
+        for zotero_item in created:
+            schema_doc = zotero_item.schema_doc
+            sb_item, sedar_filing_id = files_by_zotero_item[zotero_item]
+
             # Update the schema document with the Zotero item URL
-            archive_item.schema_doc['url'] = f"https://w3id.org/usgs/z/{self.zotero_library_id}/{zotero_item.item['key']}"
-
-            # Update the schema.org document in the ScienceBase item
-            schema_json_path = os.path.join(self.cache_path, f"{archive_item.sedar_filing_id}.json")
-            json.dump(archive_item.schema_doc, open(schema_json_path, 'w'))
-            self.sb.replace_file(
-                filename=schema_json_path,
-                item=archive_item.sb_item
-            )
+            schema_doc['url'] = zotero_item.item['url']
 
-            # Update the ScienceBase Item with the Zotero item URL
-            archive_item.sb_item['webLinks'] = [
+            # Add the Zotero item URL to the ScienceBase Item
+            sb_item['webLinks'] = [
                 {
                     "type": "metadata URL",
                     "typeLabel": "metadata URL",
@@ -130,23 +386,55 @@ class NI43101Process:
                     "hidden": False
                 }
             ]
-            archive_item.sb_item = self.sb.update_item(archive_item.sb_item)
+
+            # The finished schema.org document is uploaded to the ScienceBase item in the same call that saves the web link
+            schema_json_path = os.path.join(self.cache_path, f"{sedar_filing_id}.json")
+            try:
+                with open(schema_json_path, 'w') as f:
+                    json.dump(schema_doc, f, separators=(',', ':'))
+                sb.upload_files_and_upsert_item(
+                    item=sb_item,
+                    filenames=[schema_json_path],
+                    scrape_file=False
+                )
+            except Exception as e:
+                failures[sedar_filing_id] = e
+            finally:
+                if os.path.exists(schema_json_path):
+                    os.remove(schema_json_path)
+
+        return failures
 
 class NI43101Item:
-    def __init__(self, sb, cache_path, sb_file_meta, geokb_ref, ni43101_file_archive_item_id):
+    def __init__(
+            self,
+            sb,
+            cache_path,
+            sb_file_meta,
+            ni43101_file_archive_item_id,
+            place_lookup=None,
+            commodity_lookup=None,
+            pdf_engine='pymupdf',
+            page_workers=1,
+            upload=True
+        ):
         self.sb = sb
         self.cache_path = cache_path
         self.sb_file_meta = sb_file_meta
-        self.geokb_ref = geokb_ref
+        self.place_lookup = place_lookup
+        self.commodity_lookup = commodity_lookup
         self.ni43101_file_archive_item_id = ni43101_file_archive_item_id
+        self.pdf_engine = pdf_engine
+        self.page_workers = page_workers
         
         # workflow steps
         self.build_schema_doc()
         self.parse_pdf_text()
         self.extract_effective_date()
 
-        if self.geokb_ref:
+        if self.place_lookup:
             self.extract_locations()
+        if self.commodity_lookup:
             self.extract_commodities()
 
         self.rename_report()
@@ -154,7 +442,31 @@ class NI43101Item:
         self.prep_files()
 
         self.sb_archive_item()
-        self.upsert_sb()
+        if upload:
+            self.upsert_sb()
+
+    def __getstate__(self):
+        '''
+        A built item is handed back from a worker process without its ScienceBase session or page text, which the upload doesn't need.
+        '''
+        state = self.__dict__.copy()
+        for attr in ('sb', 'pages', 'full_text'):
+            state.pop(attr, None)
+        return state
+
+    def add_identifier(self, identifier):
+        '''
+        Add an identifier to the schema document, indexed by name (the first identifier with a given name wins).
+        '''
+        self.schema_doc['identifier'].append(identifier)
+        self._ids_by_name.setdefault(identifier['name'], identifier)
+
+    def add_media(self, media):
+        '''
+        Add a media object to the schema document, indexed by its additionalType (the first of each type wins).
+        '''
+        self.schema_doc['associatedMedia'].append(media)
+        self._media_by_type.setdefault(media['additionalType'], media)
 
     def build_schema_doc(self):
         '''
@@ -176,13 +488,15 @@ class NI43101Item:
             "about": [],
             "spatialCoverage": []
         }
+        self._ids_by_name = {}
+        self._media_by_type = {}
 
         # Get stuff from the long file name
         name_parts = [i.strip() for i in self.sb_file_meta['name'].split('/')]
 
         # The filing ID is ultimately used to name the files associated with that filing in a consistent manner
         filing_id = name_parts[2].split(' ')[0]
-        self.schema_doc['identifier'].append({
+        self.add_identifier({
             "@type": "PropertyValue",
             "name": "SEDAR filing identifier",
             "value": filing_id
@@ -205,7 +519,7 @@ class NI43101Item:
 
         # Filenames often contain former names of companies, helping to round out identifying information
         mining_company_qualified_name = name_parts[0].replace(mining_company['identifier']['value'], '').strip()
-        match = re.search(r'\((.*?)\)', mining_company_qualified_name)
+        match = COMPANY_PAREN_RE.search(mining_company_qualified_name)
 
         if match:
             company_parenthetical = match.group(1)
@@ -215,7 +529,7 @@ class NI43101Item:
         self.schema_doc['about'].append(mining_company)
 
         # Encode initial information on the file
-        sb_file_id = self.sb_file_meta['url'].split('%2F')[-1]
+        sb_file_id = dropbox_file_id(self.sb_file_meta)
         local_file_name = f"{sb_file_id}.pdf"
         local_file_path = os.path.join(self.cache_path, local_file_name)
 
@@ -229,22 +543,23 @@ class NI43101Item:
         # The original ScienceBase File ID from the dropbox is essentially meaningless after we process, rename the file, and load it to a new item
         # where it will have a completely new file identifier. Retaining it in the schema document provides a level of provenance tracing that could
         # be useful in some circumstances.
+        pdf_size, pdf_sha256, pdf_md5 = stat_and_hash(local_file_path, use_sidecar=True)
         pdf_media = {
             "@type": "MediaObject",
             "additionalType": "main content",
             "name": f"PDF Content ({sb_file_id})",
             "alternateName": self.sb_file_meta['name'],
-            "contentSize": os.path.getsize(local_file_path),
+            "contentSize": pdf_size,
             "encodingFormat": "application/pdf",
-            "sha256": calculate_checksum(local_file_path, 'sha256'),
-            "md5": calculate_checksum(local_file_path, 'md5'),
+            "sha256": pdf_sha256,
+            "md5": pdf_md5,
             "identifier": {
                 "@type": "PropertyValue",
                 "name": "Original ScienceBase File ID",
                 "value": sb_file_id
             }
         }
-        self.schema_doc['associatedMedia'].append(pdf_media)
+        self.add_media(pdf_media)
 
     def parse_pdf_text(self):
         '''
@@ -252,7 +567,7 @@ class NI43101Item:
         and checksum for the file to be used in further processing steps, both at this stage and in later data extraction work.
         The function yields the schema document with the extracted text content media object added to the associatedMedia list.
         '''
-        source_media_object = next((i for i in self.schema_doc['associatedMedia'] if i['additionalType'] == 'main content'), None)
+        source_media_object = self._media_by_type.get('main content')
         if not source_media_object:
             raise ValueError('No main content media object found in schema_doc')
         
@@ -263,26 +578,44 @@ class NI43101Item:
             self.pages = pd.read_parquet(parquet_file_path)
         else:
             pages = []
-            if self.pdf_engine == 'pdfminer':
-                from pdfminer.high_level import extract_pages
-                from pdfminer.layout import LTTextContainer
-
-                page_count = 0
-                for page_layout in extract_pages(source_file_path):
-                    page_count+=1
-                    p = {
-                        'page_num': page_count,
+            if self.pdf_engine == 'pymupdf':
+                # MuPDF extracts text in C; it isn't thread-safe, so pages are read in turn from the one open document
+                import pymupdf
+
+                with pymupdf.open(source_file_path) as doc:
+                    for page_num, page in enumerate(doc, start=1):
+                        page_content = page.get_text('text')
+                        pages.append({
+                            'page_num': page_num,
+                            'timestamp': datetime.now().isoformat(),
+                            'sha256': source_media_object['sha256'],
+                            'page_content': page_content if page_content.strip() else None
+                        })
+            elif self.pdf_engine == 'pdfminer':
+                # pdfminer is pure Python, so long reports are split into contiguous page ranges parsed in separate processes
+                if self.page_workers > 1:
+                    page_count = _pdfminer_page_count(source_file_path)
+                    if page_count == 0:
+                        # Nothing to split into page ranges
+                        page_texts = []
+                    else:
+                        chunk_size = -(-page_count // self.page_workers)
+                        page_ranges = [range(start, min(start + chunk_size, page_count)) for start in range(0, page_count, chunk_size)]
+                        with ProcessPoolExecutor(max_workers=len(page_ranges)) as executor:
+                            page_texts = [
+                                text for chunk in executor.map(_pdfminer_page_texts, [source_file_path] * len(page_ranges), page_ranges)
+                                for text in chunk
+                            ]
+                else:
+                    page_texts = _pdfminer_page_texts(source_file_path)
+
+                for page_num, page_content in enumerate(page_texts, start=1):
+                    pages.append({
+                        'page_num': page_num,
                         'timestamp': datetime.now().isoformat(),
                         'sha256': source_media_object['sha256'],
-                        'page_content': None
-                    }
-                    text_chunks = []
-                    for element in page_layout:
-                        if isinstance(element, LTTextContainer) and len(element.get_text().strip()) > 0:
-                            text_chunks.append(element.get_text())
-                    if text_chunks:
-                        p['page_content'] = '\n'.join(text_chunks)
-                    pages.append(p)
+                        'page_content': page_content
+                    })
             elif self.pdf_engine == 'pypdf':
                 import PyPDF2
 
@@ -298,20 +631,32 @@ class NI43101Item:
                         }
                         pages.append(p)
 
-            self.pages = pd.DataFrame(pages)
-            self.pages.to_parquet(parquet_file_path)
+            self.pages = pd.DataFrame(pages, columns=['page_num', 'timestamp', 'sha256', 'page_content']).astype({'page_num': 'int32'})
+
+            # Report text compresses well with zstd and the file checksum repeats on every row, so it is dictionary encoded;
+            # smaller files are quicker to hash and upload
+            self.pages.to_parquet(
+                parquet_file_path,
+                engine='pyarrow',
+                compression='zstd',
+                compression_level=3,
+                use_dictionary=['sha256', 'timestamp'],
+                row_group_size=64,
+                index=False
+            )
 
-        parquet_media_object = next((i for i in self.schema_doc['associatedMedia'] if i['additionalType'] == 'extracted text content'), None)
+        parquet_media_object = self._media_by_type.get('extracted text content')
 
         if not parquet_media_object:
+            parquet_size, parquet_sha256, parquet_md5 = stat_and_hash(parquet_file_path, use_sidecar=True)
             parquet_media = {
                 "@type": "MediaObject",
                 "additionalType": "extracted text content",
                 "name": f"Page Text Content ({source_media_object['identifier']['value']})",
-                "contentSize": os.path.getsize(parquet_file_path),
+                "contentSize": parquet_size,
                 "encodingFormat": "application/vnd.apache.parquet",
-                "sha256": calculate_checksum(parquet_file_path, 'sha256'),
-                "md5": calculate_checksum(parquet_file_path, 'md5'),
+                "sha256": parquet_sha256,
+                "md5": parquet_md5,
                 "identifier": {
                     "@type": "PropertyValue",
                     "name": "ScienceBase File Source ID",
@@ -319,9 +664,12 @@ class NI43101Item:
                 }
             }
 
-            self.schema_doc['associatedMedia'].append(parquet_media)
+            self.add_media(parquet_media)
 
             self.schema_doc['numberOfPages'] = len(self.pages)
+
+        # Term extraction scans the whole document at once, so the page text is joined here a single time for every scan
+        self.full_text = '\n'.join(self.pages['page_content'].dropna())
         
     def extract_effective_date(self):
         '''
@@ -337,14 +685,14 @@ class NI43101Item:
         
     def extract_locations(self):
         '''
-        This function parses through each page in the document to find named places based solely on the slate of administrative place names
+        This function scans the full text of the document to find named places based solely on the slate of administrative place names
         organized into the Geoscience Knowledgebase. It then selects for the most predominant place names found with Z-score normalization, selecting
         for cases with a Z-score above 2. The function then adds these place names to the spatialCoverage field in the schema document, including their
         associated GeoKB identifiers for use in linking the document to the knowledge graph. Place names are used in the Zotero representation as tags.
         '''
         locations_in_texts = extract_linkable_terms(
-            documents=self.pages['page_content'].to_list(),
-            terms=self.geokb_ref.place_lookup
+            documents=[self.full_text],
+            terms=self.place_lookup
         )
         if locations_in_texts:
             for loc_name, loc_id in locations_in_texts.items():
@@ -361,14 +709,14 @@ class NI43101Item:
         
     def extract_commodities(self):
         '''
-        This function parses through each page in the document to find commodity names based solely on the slate of commodity names and identifiers
+        This function scans the full text of the document to find commodity names based solely on the slate of commodity names and identifiers
         organized into the Geoscience Knowledgebase. It then selects for the most predominant comm,odities found with Z-score normalization, selecting
         for cases with a Z-score above 2. The function then adds these commodity names and their GeoKB identifiers to the about information in the
         schema document. Commodity entities are linked in the GeoKB as addresses subject claims and names are used in the Zotero representation as tags.
         '''
         commodities_in_texts = extract_linkable_terms(
-            documents=[d.lower() for d in self.pages['page_content']],
-            terms=self.geokb_ref.commodity_lookup
+            documents=[self.full_text.lower()],
+            terms=self.commodity_lookup
         )
         if commodities_in_texts:
             for commodity_name, commodity_id in commodities_in_texts.items():
@@ -395,11 +743,11 @@ class NI43101Item:
     def prep_files(self):
         '''
         This function prepares the files for loading into a new ScienceBase item. It renames the files to match the SEDAR filing ID and moves them
-        to the cache path for the new item. It also writes the schema document to a JSON file in the cache path. The function returns the list of files
-        that are used to generate the new ScienceBase archive item container that will house files associated with the filing.
+        to the cache path for the new item. The function returns the list of files that are used to generate the new ScienceBase archive item container
+        that will house files associated with the filing. The schema document is uploaded as a JSON file later, once it is complete.
         '''
-        self.sedar_filing_id = next((i['value'] for i in self.schema_doc['identifier'] if i['name'] == 'SEDAR Filing ID'), None)
-        sb_file_id = next((i['identifier']['value'] for i in self.schema_doc['associatedMedia'] if i['additionalType'] == 'main content'), None)
+        self.sedar_filing_id = self._ids_by_name['SEDAR filing identifier']['value']
+        sb_file_id = self._media_by_type['main content']['identifier']['value']
         self.item_files = []
 
         pdf_file_path = os.path.join(self.cache_path, f"{self.sedar_filing_id}.pdf")
@@ -416,9 +764,12 @@ class NI43101Item:
         )
         self.item_files.append(parquet_file_path)
 
-        json_file_path = os.path.join(self.cache_path, f"{self.sedar_filing_id}.json")
-        json.dump(self.schema_doc, open(json_file_path, 'w'))
-        self.item_files.append(json_file_path)
+        # Checksum sidecars only serve reruns against the cached source files, which are now renamed for upload
+        for ext in ('pdf', 'parquet'):
+            sidecar_path = checksum_sidecar_path(os.path.join(self.cache_path, f"{sb_file_id}.{ext}"))
+            if os.path.exists(sidecar_path):
+                os.remove(sidecar_path)
+
 
     def sb_archive_item(self):
         '''
@@ -441,6 +792,7 @@ class NI43101Item:
     def upsert_sb(self):
         '''
         This function uploads the files and the item to ScienceBase and then removed the local cached files.
+        The schema document JSON is not uploaded here; that happens once after the Zotero item is created (NI43101Process.publish_items).
         '''
         self.sb_item = self.sb.upload_files_and_upsert_item(
             item=self.sb_item_shell, 
@@ -450,7 +802,7 @@ class NI43101Item:
 
         # We add the w3id.org form of the ScienceBase item ID to the schema document for linking purposes
         # This becomes the archiveLocation attribute in Zotero and the archivedAt claim in the GeoKB
-        self.schema_doc['identifier'].append({
+        self.add_identifier({
             "@type": "PropertyValue",
             "name": "ScienceBase Item ID",
             "value": self.sb_item['id'],
@@ -458,21 +810,17 @@ class NI43101Item:
         })
 
         # Using the MD5 checksum recorded previously, we can verify the onboard ScienceBase file object and add its URL to the schema document
+        files_by_md5 = {
+            f['checksum']['value']: f for f in self.sb_item['files']
+            if f.get('checksum', {}).get('type') == 'MD5'
+        }
         for media in self.schema_doc['associatedMedia']:
-            sb_file_obj = next((f for f in self.sb_item['files'] if f['checksum']['value'] == media['md5']), None)
+            sb_file_obj = files_by_md5.get(media['md5'])
             if not sb_file_obj:
                 raise ValueError(f"Failed to find ScienceBase file object for {media['name']}")
             media['url'] = sb_file_obj['url']
             del media['md5']
 
-        # Changes to the schema document are saved and reloaded into the ScienceBase item        
-        schema_json_path = os.path.join(self.cache_path, f"{self.sedar_filing_id}.json")
-        json.dump(self.schema_doc, open(schema_json_path, 'w'))
-        self.sb_item = self.sb.replace_file(
-            filename=schema_json_path,
-            item=self.sb_item
-        )
-
         # Remove the local processing files
         for f in self.item_files:
             os.remove(f)
@@ -1,7 +1,49 @@
 import os
+import secrets
 from pyzotero import zotero
 from dateutil import parser
 
+# The Zotero API creates at most 50 items per request
+CREATE_BATCH_SIZE = 50
+
+# Zotero object keys are 8 characters drawn from this alphabet
+ITEM_KEY_CHARS = '23456789ABCDEFGHIJKLMNPQRSTUVWXYZ'
+
+def new_item_key():
+    return ''.join(secrets.choice(ITEM_KEY_CHARS) for _ in range(8))
+
+def commit_items(zots: list, batch_size: int = CREATE_BATCH_SIZE):
+    '''
+    Commit the Zotero items of several Zot objects (in the same library) with as few create calls as the API allows.
+    Item keys are assigned here rather than by the server so that each item's w3id.org URL is set when it is created,
+    without a second round trip per item. The created item data is set on each Zot as its item attribute.
+    Zotero creates the items of a batch independently, so a failed item doesn't undo the rest; the Zot objects that were
+    created are returned along with (Zot, error) pairs for those that weren't, and the caller decides how to handle them.
+    '''
+    created = []
+    failed = []
+    for start in range(0, len(zots), batch_size):
+        batch = zots[start:start + batch_size]
+        for zot in batch:
+            zot.z_item.setdefault('key', new_item_key())
+            zot.z_item['url'] = f"https://w3id.org/usgs/z/{zot.library_id}/{zot.z_item['key']}"
+
+        try:
+            z_create_response = batch[0].z.create_items([zot.z_item for zot in batch])
+        except Exception as e:
+            failed.extend((zot, e) for zot in batch)
+            continue
+
+        for idx, zot in enumerate(batch):
+            if str(idx) in z_create_response['successful']:
+                zot.item = z_create_response['successful'][str(idx)]['data']
+                created.append(zot)
+            else:
+                failure = z_create_response['failed'].get(str(idx))
+                failed.append((zot, ValueError(f"Failed to create Zotero item: {failure}")))
+
+    return created, failed
+
 class Zot:
     def __init__(self, library_id: str, schema_doc: dict, commit: bool = False):
         self.library_id = library_id
@@ -66,13 +108,8 @@ class Zot:
 
     def commit(self):
         '''
-        Commit the Zotero item to the Zotero library and update the URL with the w3id.org link.
+        Commit the Zotero item to the Zotero library, including its w3id.org URL.
         '''
-        z_create_response = self.z.create_items([self.z_item])
-
-        self.item = z_create_response['successful']['0']['data']
-
-        self.item['url'] = f"https://w3id.org/usgs/z/{self.library_id}/{self.z_item['key']}"
-        self.z.update_item(self.z_item)
-
-        
+        created, failed = commit_items([self])
+        if failed:
+            raise failed[0][1]
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import pytest
+from geoarchive import calculate_checksum, calculate_checksums, stat_and_hash, extract_linkable_terms, extract_date
+
+@pytest.fixture
+def sample_file(tmp_path):
+    file_path = tmp_path / 'sample.bin'
+    file_path.write_bytes(b'geoarchive' * 300000)
+    return file_path
+
+def test_calculate_checksum(sample_file):
+    content = sample_file.read_bytes()
+    assert calculate_checksum(str(sample_file)) == hashlib.sha256(content).hexdigest()
+    assert calculate_checksum(str(sample_file), 'md5') == hashlib.md5(content).hexdigest()
+
+def test_calculate_checksum_empty_file(tmp_path):
+    file_path = tmp_path / 'empty.bin'
+    file_path.write_bytes(b'')
+    assert calculate_checksum(str(file_path)) == hashlib.sha256(b'').hexdigest()
+
+def test_stat_and_hash(sample_file):
+    content = sample_file.read_bytes()
+    assert stat_and_hash(str(sample_file)) == (len(content), hashlib.sha256(content).hexdigest(), hashlib.md5(content).hexdigest())
+    assert not os.path.exists(f'{sample_file}.checksums.json')
+
+def test_stat_and_hash_sidecar(sample_file, monkeypatch):
+    import geoarchive
+    expected = stat_and_hash(str(sample_file))
+    assert stat_and_hash(str(sample_file), use_sidecar=True) == expected
+    assert os.path.exists(f'{sample_file}.checksums.json')
+
+    # An unchanged file is served from the sidecar
+    monkeypatch.setattr(geoarchive, '_update_hashes', lambda *args: pytest.fail('file was rehashed'))
+    assert stat_and_hash(str(sample_file), use_sidecar=True) == expected
+    monkeypatch.undo()
+
+    # A changed file is hashed again
+    sample_file.write_bytes(b'changed')
+    assert stat_and_hash(str(sample_file), use_sidecar=True)[2] == hashlib.md5(b'changed').hexdigest()
+
+def test_truncated_sidecar_is_a_cache_miss(sample_file):
+    expected = stat_and_hash(str(sample_file))
+    sidecar = f'{sample_file}.checksums.json'
+    with open(sidecar, 'w') as f:
+        f.write('{"size": 30')
+
+    assert stat_and_hash(str(sample_file), use_sidecar=True) == expected
+    assert stat_and_hash(str(sample_file), use_sidecar=True) == expected
+    # The sidecar was rewritten in place, with no temporary files left behind
+    assert sorted(p.name for p in sample_file.parent.iterdir()) == ['sample.bin', 'sample.bin.checksums.json']
+
+def test_calculate_checksums(tmp_path):
+    file_paths = []
+    for i in range(10):
+        file_path = tmp_path / f'file_{i}.bin'
+        file_path.write_bytes(bytes([i]) * (i * 1000))
+        file_paths.append(str(file_path))
+
+    checksums = calculate_checksums(file_paths, 'md5')
+    assert list(checksums) == file_paths
+    assert all(checksums[p] == calculate_checksum(p, 'md5') for p in file_paths)
+    assert calculate_checksums([]) == {}
+
+def test_extract_linkable_terms():
+    terms = {name: f'Q{i}' for i, name in enumerate(['nevada', 'utah', 'idaho', 'oregon', 'montana', 'arizona', 'texas', 'ohio', 'maine', 'iowa'])}
+    documents = [' '.join(name for name in terms if name != 'nevada'), 'nevada ' * 50, None, '']
+
+    assert extract_linkable_terms(documents, terms) == {'nevada': 'Q0'}
+    assert extract_linkable_terms(documents, dict(terms, nevada='Q99')) == {'nevada': 'Q99'}
+
+def test_extract_linkable_terms_order_is_stable():
+    import subprocess
+    import sys
+
+    script = (
+        "from geoarchive import extract_linkable_terms;"
+        "terms = {name: name for name in ['nevada', 'utah', 'idaho', 'oregon', 'montana', 'arizona', 'texas', 'ohio', 'maine', 'iowa', 'kansas', 'alaska', 'hawaii', 'vermont', 'georgia', 'florida', 'indiana', 'alabama', 'wyoming', 'colorado']};"
+        "print(list(extract_linkable_terms([' '.join(terms) + ' utah nevada' * 40], terms)))"
+    )
+    outputs = {
+        subprocess.run([sys.executable, '-c', script], env=dict(os.environ, PYTHONHASHSEED=seed), capture_output=True, text=True, check=True).stdout
+        for seed in ['1', '2', '3']
+    }
+    assert outputs == {"['nevada', 'utah']\n"}
+
+def test_extract_linkable_terms_without_outliers():
+    terms = {'gold': 'Q1', 'silver': 'Q2'}
+
+    assert extract_linkable_terms(['no metals here'], terms) == {}
+    assert extract_linkable_terms(['gold silver gold silver'], terms) == {}
+
+def test_terms_do_not_match_across_documents():
+    from geoarchive import _count_terms_automaton
+
+    term_array, counts = _count_terms_automaton(['go', 'ld'], frozenset(['gold']))
+    assert not counts.any()
+
+def test_automaton_cached_on_disk(tmp_path, monkeypatch):
+    import geoarchive
+    monkeypatch.setattr('geoarchive.CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr('geoarchive.AUTOMATON_CACHE_MIN_TERMS', 1)
+
+    term_keys = frozenset(['gold', 'silver', 'copper'])
+    documents = ['gold and silver, gold']
+    geoarchive._load_or_build_automaton.cache_clear()
+    term_array, counts = geoarchive._count_terms_automaton(documents, term_keys)
+    assert len(list(tmp_path.glob('ac_*.pkl'))) == 1
+
+    geoarchive._load_or_build_automaton.cache_clear()
+    cached_terms, cached_counts = geoarchive._count_terms_automaton(documents, term_keys)
+    geoarchive._load_or_build_automaton.cache_clear()
+    assert dict(zip(cached_terms, cached_counts)) == dict(zip(term_array, counts)) == {'gold': 2, 'silver': 1, 'copper': 0}
+
+def test_automaton_cache_failures_are_misses(tmp_path, monkeypatch):
+    import geoarchive
+    monkeypatch.setattr('geoarchive.AUTOMATON_CACHE_MIN_TERMS', 1)
+    term_keys = frozenset(['gold', 'silver'])
+
+    # A cache directory that can't be created
+    monkeypatch.setattr('geoarchive.CACHE_DIR', '/proc/geoarchive-cache')
+    geoarchive._load_or_build_automaton.cache_clear()
+    term_array, counts = geoarchive._count_terms_automaton(['gold'], term_keys)
+    assert dict(zip(term_array, counts)) == {'gold': 1, 'silver': 0}
+
+    # A cache file cut short by a killed run is rebuilt and replaced
+    monkeypatch.setattr('geoarchive.CACHE_DIR', str(tmp_path))
+    geoarchive._load_or_build_automaton.cache_clear()
+    geoarchive._count_terms_automaton(['gold'], term_keys)
+    cache_file, = tmp_path.glob('ac_*.pkl')
+    cache_file.write_bytes(cache_file.read_bytes()[:20])
+
+    geoarchive._load_or_build_automaton.cache_clear()
+    term_array, counts = geoarchive._count_terms_automaton(['gold'], term_keys)
+    geoarchive._load_or_build_automaton.cache_clear()
+    assert dict(zip(term_array, counts)) == {'gold': 1, 'silver': 0}
+    assert [p.name for p in tmp_path.iterdir()] == [cache_file.name]
+
+def test_hyperscan_counts_match_automaton():
+    pytest.importorskip('hyperscan')
+    from geoarchive import _count_terms_automaton, _count_terms_hyperscan
+
+    term_keys = frozenset(['gold', 'gold mine', 'old', 'copper', 'niño'])
+    documents = ['The gold mine produced gold and copper.', 'Old gold, niño', '', None, 'go', 'ld']
+    hyperscan_terms, hyperscan_counts = _count_terms_hyperscan(documents, term_keys)
+    automaton_terms, automaton_counts = _count_terms_automaton(documents, term_keys)
+    assert dict(zip(hyperscan_terms, hyperscan_counts)) == dict(zip(automaton_terms, automaton_counts))
+
+@pytest.mark.parametrize('document, expected', [
+    ('Effective date: 2021-03-15, revised 2020-12-31', '2021-03-15T00:00:00'),
+    ('Signed 04/05/2019 and 25/12/2018', '2019-04-05T00:00:00'),
+    ('Report dated 12-31-2017', '2017-12-31T00:00:00'),
+    ('Effective 5th March 2022, filed on 1 April 2022', '2022-04-01T00:00:00'),
+    ('Prepared for the company, June 30, 2023 and July 1st, 2023', '2023-07-01T00:00:00'),
+    ('Effective Date: 2019-01-01 with an update on September 15, 2020', '2020-09-15T00:00:00'),
+    ('Updated Sept 15, 2021 from the 15 Sept 2020 report', '2021-09-15T00:00:00'),
+    ('Amended 2021-13-01 from the 2021-05-01 and 2020-06-30 filings', '2021-05-01T00:00:00'),
+    ('Report No. 12 dated 2021-06-30', '2021-06-30T00:00:00'),
+    ('Amendment 2 effective 2022-01-15', '2022-01-15T00:00:00'),
+    ('Filed 31/02/2020 and 2020-02-30', None),
+    ('No dates in this text', None),
+])
+def test_extract_date(document, expected):
+    assert extract_date(document) == expected
@@ -1,6 +1,9 @@
 import os
 import pytest
-from geoarchive.geokb import GeoKB
+import pandas as pd
+import requests
+from unittest.mock import MagicMock
+from geoarchive.geokb import GeoKB, Ref
 
 def test_auth(geokb_env):
     assert os.environ['WB_SPARQL_ENDPOINT'] == 'https://geokb.wikibase.cloud/query/sparql'
@@ -17,3 +20,168 @@ def test_auth(geokb_env):
 #     )
 #     zot.check_env()  # Should not raise an exception
 
+
+def fake_sparql_records(query):
+    if '?archived_at' in query:
+        return pd.DataFrame({
+            'item': ['https://geokb.wikibase.cloud/entity/Q10'],
+            'archived_at': ['https://w3id.org/usgs/sb/abc']
+        })
+    return pd.DataFrame(columns=['item', 'company_id'])
+
+def fake_sparql_query(query):
+    return pd.DataFrame({
+        'item': ['https://geokb.wikibase.cloud/entity/Q1'],
+        'itemLabel': ['Gold']
+    })
+
+def test_ref_caches_sparql_results(tmp_path, monkeypatch):
+    monkeypatch.setattr('geoarchive.geokb.CACHE_DIR', str(tmp_path))
+    geokb_con = MagicMock()
+    geokb_con.wb.sparql_query.side_effect = fake_sparql_query
+
+    ref = Ref(geokb_con=geokb_con)
+    assert ref.commodity_lookup == {'gold': 'https://geokb.wikibase.cloud/entity/Q1'}
+    assert geokb_con.wb.sparql_query.call_count == 2
+
+    # Reference lookups come from the disk cache
+    Ref(geokb_con=geokb_con)
+    assert geokb_con.wb.sparql_query.call_count == 2
+
+    Ref(geokb_con=geokb_con, cache_ttl=0)
+    assert geokb_con.wb.sparql_query.call_count == 4
+
+def test_ref_cache_failures_are_misses(tmp_path, monkeypatch):
+    geokb_con = MagicMock()
+    geokb_con.wb.sparql_query.side_effect = fake_sparql_query
+
+    # A cache directory that can't be created
+    monkeypatch.setattr('geoarchive.geokb.CACHE_DIR', '/proc/geoarchive-cache')
+    assert Ref(geokb_con=geokb_con).commodity_lookup == {'gold': 'https://geokb.wikibase.cloud/entity/Q1'}
+
+    # Cache files cut short by a killed run are queried again and replaced
+    monkeypatch.setattr('geoarchive.geokb.CACHE_DIR', str(tmp_path))
+    Ref(geokb_con=geokb_con)
+    for cache_file in tmp_path.glob('sparql_*.pkl'):
+        cache_file.write_bytes(b'')
+    geokb_con.wb.sparql_query.reset_mock()
+
+    assert Ref(geokb_con=geokb_con).commodity_lookup == {'gold': 'https://geokb.wikibase.cloud/entity/Q1'}
+    assert geokb_con.wb.sparql_query.call_count == 2
+    assert all(cache_file.stat().st_size for cache_file in tmp_path.glob('sparql_*.pkl'))
+
+def test_ref_item_indexes_built_on_first_use(tmp_path, monkeypatch):
+    monkeypatch.setattr('geoarchive.geokb.CACHE_DIR', str(tmp_path))
+    geokb_con = MagicMock()
+    geokb_con.wb.sparql_query.side_effect = fake_sparql_query
+    geokb_con.sparql_records.side_effect = fake_sparql_records
+
+    ref = Ref(geokb_con=geokb_con)
+    geokb_con.sparql_records.assert_not_called()
+
+    assert ref.archived_at_lookup == {'https://w3id.org/usgs/sb/abc': 'Q10'}
+    assert ref.sedar_lookup == {}
+    ref.sedar_lookup['12345'] = 'Q20'
+    assert ref.sedar_lookup == {'12345': 'Q20'}
+    assert geokb_con.sparql_records.call_count == 2
+
+def test_ref_item_index_not_cached_after_failed_query(tmp_path, monkeypatch):
+    monkeypatch.setattr('geoarchive.geokb.CACHE_DIR', str(tmp_path))
+    geokb_con = MagicMock()
+    geokb_con.wb.sparql_query.side_effect = fake_sparql_query
+    geokb_con.sparql_records.side_effect = [requests.HTTPError('503 Server Error'), fake_sparql_records('?archived_at')]
+
+    ref = Ref(geokb_con=geokb_con)
+    with pytest.raises(requests.HTTPError):
+        ref.archived_at_lookup
+    assert ref.archived_at_lookup == {'https://w3id.org/usgs/sb/abc': 'Q10'}
+
+def test_sparql_records(geokb_env, monkeypatch):
+    from geoarchive.geokb import GeoKB
+
+    geokb_con = GeoKB.__new__(GeoKB)
+    response = MagicMock()
+    response.json.return_value = {
+        'head': {'vars': ['item', 'company_id']},
+        'results': {'bindings': [{'item': {'value': 'https://geokb.wikibase.cloud/entity/Q20'}}]}
+    }
+    monkeypatch.setattr('geoarchive.geokb.requests.get', MagicMock(return_value=response))
+    df = geokb_con.sparql_records('SELECT ?item ?company_id WHERE {}')
+    assert df.to_dict('records') == [{'item': 'https://geokb.wikibase.cloud/entity/Q20', 'company_id': None}]
+
+    # No results is an empty frame, not None
+    response.json.return_value['results']['bindings'] = []
+    assert list(geokb_con.sparql_records('SELECT ?item ?company_id WHERE {}').columns) == ['item', 'company_id']
+
+    # A failed request raises rather than passing for "not found"
+    response.raise_for_status.side_effect = requests.HTTPError('502 Server Error')
+    with pytest.raises(requests.HTTPError):
+        geokb_con.sparql_records('SELECT ?item ?company_id WHERE {}')
+
+def test_entity_from_schema_adds_commodity_subjects():
+    from geoarchive.geokb import Entity
+
+    geokb_con = MagicMock()
+    geokb_con.wb.props = {name: {'property': name} for name in [
+        'instance of', 'SEDAR filing identifier', 'owner', 'metadata URL', 'archivedAt', 'MIME type',
+        'content URL', 'sha256', 'data size', 'access restricted to', 'addresses place', 'addresses subject'
+    ]}
+    geokb_con.wb.datatypes.Item.side_effect = lambda prop_nr, value: (prop_nr, value)
+
+    entity = Entity.__new__(Entity)
+    entity.geokb_con = geokb_con
+    entity.company_item = None
+    entity.item = MagicMock()
+    entity.schema_doc = {
+        'name': 'Report',
+        'abstract': 'Abstract',
+        'url': 'https://www.zotero.org/groups/12345/items/ABC',
+        'identifier': [{'name': 'SEDAR filing identifier', 'value': '00001'}],
+        'about': [
+            {'additional_type': 'commodity', 'identifier': {'value': 'Q1'}},
+            {'additional_type': 'commodity', 'identifier': {'value': 'Q2'}}
+        ],
+        'associatedMedia': [],
+        'spatialCoverage': [{'identifier': {'value': 'Q3'}}]
+    }
+    entity.index_schema_doc()
+    entity.entity_from_schema()
+
+    entity.item.claims.add.assert_called_once()
+    claims = entity.item.claims.add.call_args.args[0]
+    assert ('addresses place', 'Q3') in claims
+    assert ('addresses subject', 'Q1') in claims
+    assert ('addresses subject', 'Q2') in claims
+
+def test_entity_uses_ref_indexes():
+    from geoarchive.geokb import Entity
+
+    geokb_ref = MagicMock()
+    geokb_ref.archived_at_lookup = {'https://w3id.org/usgs/sb/abc': 'Q10'}
+    geokb_ref.sedar_lookup = {'12345': 'Q20'}
+    geokb_con = geokb_ref.geokb_con
+    geokb_con.wb.wbi.item.get.side_effect = lambda qid: MagicMock(id=qid)
+
+    entity = Entity(
+        schema_doc={
+            'name': 'Report',
+            'abstract': 'Abstract',
+            'url': 'https://w3id.org/usgs/z/12345/ABC',
+            'identifier': [
+                {'name': 'SEDAR filing identifier', 'value': '00001'},
+                {'name': 'ScienceBase Item ID', 'value': 'abc', 'url': 'https://w3id.org/usgs/sb/abc'}
+            ],
+            'about': [{'additional_type': 'company', 'name': 'Mining Co', 'identifier': {'value': '12345'}}],
+            'associatedMedia': [],
+            'spatialCoverage': []
+        },
+        geokb_ref=geokb_ref
+    )
+
+    # Both items already exist, so they are fetched by QID and nothing is queried or created
+    assert entity.archived_at == 'https://w3id.org/usgs/sb/abc'
+    assert entity.metadata_url == 'https://w3id.org/usgs/z/12345/ABC'
+    assert [call.args[0] for call in geokb_con.wb.wbi.item.get.call_args_list] == ['Q20', 'Q10']
+    geokb_con.wb.wbi.item.new.assert_not_called()
+    geokb_con.sparql_records.assert_not_called()
+    assert entity.write_summary == 'updated NI 43-101 entity from schema.org source document'
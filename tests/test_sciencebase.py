@@ -1,6 +1,240 @@
 import os
 import pytest
+import requests
+import pyarrow.parquet as pq
+from unittest.mock import MagicMock
+from geoarchive.sciencebase import NI43101Item, sb_session
 
 def test_auth(sciencebase_env):
     assert os.environ['SB_ACCESS_TOKEN'] == 'fake_access_token'
     assert os.environ['SB_REFRESH_TOKEN'] == 'fake_refresh_token'
+
+def test_sb_session_pools_connections(sciencebase_env, monkeypatch):
+    sb = MagicMock()
+    sb._session = requests.Session()
+    monkeypatch.setattr('geoarchive.sciencebase.SbSession', lambda: sb)
+
+    assert sb_session() is sb
+    sb.add_token.assert_called_once_with({'access_token': 'fake_access_token', 'refresh_token': 'fake_refresh_token'})
+    adapter = sb._session.get_adapter('https://www.sciencebase.gov/catalog/')
+    assert adapter._pool_maxsize == 32
+    assert adapter.max_retries.total == 3
+
+def write_pdf(path, page_texts):
+    # Minimal PDF with one line of Helvetica text per page
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in page_texts:
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'
+        objects.append(f'<< /Length {len(stream)} >>\nstream\n{stream}\nendstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        kids.append(f'{len(objects)} 0 R')
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for num, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f'{num} 0 obj\n{obj}\nendobj\n'.encode('latin-1')
+    xref = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode('latin-1')
+    pdf += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode('latin-1')
+    pdf += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode('latin-1')
+    path.write_bytes(pdf)
+
+def pdf_item(tmp_path, page_texts, **kwargs):
+    write_pdf(tmp_path / 'abc.pdf', page_texts)
+
+    item = NI43101Item.__new__(NI43101Item)
+    item.cache_path = str(tmp_path)
+    item.pdf_engine = 'pdfminer'
+    item.page_workers = 1
+    item.__dict__.update(kwargs)
+    item.schema_doc = {'identifier': [], 'associatedMedia': []}
+    item._ids_by_name = {}
+    item._media_by_type = {}
+    item.add_media({
+        'additionalType': 'main content',
+        'sha256': 'sha',
+        'identifier': {'value': 'abc'}
+    })
+    return item
+
+@pytest.mark.parametrize('page_workers', [1, 2])
+def test_parse_pdf_text(tmp_path, page_workers):
+    page_texts = [f'Page {i} text' for i in range(1, 6)]
+    item = pdf_item(tmp_path, page_texts, page_workers=page_workers)
+    item.parse_pdf_text()
+
+    assert item.pages['page_num'].tolist() == [1, 2, 3, 4, 5]
+    assert [text.strip() for text in item.pages['page_content']] == page_texts
+    assert item.schema_doc['numberOfPages'] == 5
+    parquet_metadata = pq.ParquetFile(tmp_path / 'abc.parquet').metadata
+    assert parquet_metadata.row_group(0).column(0).compression == 'ZSTD'
+    assert parquet_metadata.schema.to_arrow_schema().field('page_num').type == 'int32'
+
+def test_parse_pdf_text_without_pages(tmp_path):
+    item = pdf_item(tmp_path, [], page_workers=2)
+    item.parse_pdf_text()
+
+    assert item.pages.empty
+    assert item.schema_doc['numberOfPages'] == 0
+
+def test_parse_pdf_text_pymupdf(tmp_path):
+    page_texts = ['First page', 'Second page']
+    item = pdf_item(tmp_path, page_texts, pdf_engine='pymupdf')
+    item.parse_pdf_text()
+
+    assert item.pages['page_num'].tolist() == [1, 2]
+    assert [text.strip() for text in item.pages['page_content']] == page_texts
+
+def test_process_files_async(tmp_path, monkeypatch):
+    import asyncio
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from geoarchive import sciencebase
+    from geoarchive.sciencebase import NI43101Process
+
+    # Threads stand in for the worker processes so the patched functions apply
+    monkeypatch.setattr('geoarchive.sciencebase.ProcessPoolExecutor', ThreadPoolExecutor)
+    sessions = {}
+    def login():
+        sessions[threading.get_ident()] = MagicMock()
+        return sessions[threading.get_ident()]
+
+    monkeypatch.setattr('geoarchive.sciencebase.sb_session', login)
+    def build_file(f):
+        if f['name'] == 'file3':
+            raise ValueError('unreadable PDF')
+        archive_item = MagicMock(schema_doc={'name': f['name']}, sb_item={'id': f['name']}, sedar_filing_id=f['name'])
+        archive_item.upsert_sb.side_effect = lambda: uploaded.append((archive_item.sb, sessions.get(threading.get_ident())))
+        return archive_item
+
+    uploaded = []
+    monkeypatch.setattr('geoarchive.sciencebase._build_file', build_file)
+
+    process = NI43101Process.__new__(NI43101Process)
+    process.__dict__.update(
+        cache_path=str(tmp_path),
+        place_lookup=None,
+        commodity_lookup=None,
+        ni43101_file_archive_item_id='archive',
+        pdf_engine='pymupdf',
+        page_workers=1,
+        sb=MagicMock(),
+        publish_items=MagicMock(return_value={}),
+        dropbox_item={'files': [{'name': f'file{i}', 'url': f'https://sb/file%2F{i}'} for i in range(5)]}
+    )
+    (tmp_path / '0.pdf').write_bytes(b'%PDF')
+
+    with pytest.warns(UserWarning, match='file3'):
+        failures = asyncio.run(process.process_files_async(max_workers=2, max_downloads=2, max_uploads=1))
+
+    assert list(failures) == ['file3']
+    assert sorted(call.args[0][0][2] for call in process.publish_items.call_args_list) == ['file0', 'file1', 'file2', 'file4']
+
+    # Network calls use a session opened by the thread making them, never the process's shared one, and the
+    # worker processes don't log in at all. Files already in the cache path aren't downloaded again.
+    assert sciencebase._worker['sb'] is None
+    assert len(sessions) <= 3
+    process.sb.download_file.assert_not_called()
+    assert sum(sb.download_file.call_count for sb in sessions.values()) == 4
+    assert len(uploaded) == 4 and all(sb is thread_sb for sb, thread_sb in uploaded)
+    assert all(call.kwargs['sb'] in sessions.values() for call in process.publish_items.call_args_list)
+
+def test_process_files_publishes_around_failures(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from geoarchive.sciencebase import NI43101Process
+
+    monkeypatch.setattr('geoarchive.sciencebase.ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr('geoarchive.sciencebase.sb_session', MagicMock)
+    def process_file(f):
+        if f['name'] == 'file2':
+            raise ValueError('unreadable PDF')
+        return {'name': f['name']}, {'id': f['name']}, f['name']
+
+    monkeypatch.setattr('geoarchive.sciencebase._process_file', process_file)
+    monkeypatch.setattr('geoarchive.sciencebase.zotero.CREATE_BATCH_SIZE', 2)
+
+    process = NI43101Process.__new__(NI43101Process)
+    process.__dict__.update(
+        cache_path=str(tmp_path),
+        place_lookup=None,
+        commodity_lookup=None,
+        ni43101_file_archive_item_id='archive',
+        pdf_engine='pymupdf',
+        page_workers=1,
+        publish_items=MagicMock(return_value={}),
+        dropbox_item={'files': [{'name': f'file{i}'} for i in range(5)]}
+    )
+
+    with pytest.warns(UserWarning, match='file2'):
+        failures = process.process_files(max_workers=2)
+
+    assert list(failures) == ['file2']
+    published = [sedar_filing_id for call in process.publish_items.call_args_list for _, _, sedar_filing_id in call.args[0]]
+    assert sorted(published) == ['file0', 'file1', 'file3', 'file4']
+
+def test_extract_terms_from_full_text(tmp_path):
+    page_texts = ['Utah Idaho Oregon Montana Arizona copper silver zinc lead iron', '', 'Gold in Nevada ' * 10, 'GOLD from Nevada ' * 10]
+    item = pdf_item(tmp_path, page_texts)
+    item.schema_doc.update(about=[], spatialCoverage=[])
+    item.place_lookup = {name: f'Q{i}' for i, name in enumerate(['Nevada', 'Utah', 'Idaho', 'Oregon', 'Montana', 'Arizona'])}
+    item.commodity_lookup = {name: f'Q1{i}' for i, name in enumerate(['gold', 'copper', 'silver', 'zinc', 'lead', 'iron'])}
+    item.parse_pdf_text()
+    assert item.pages['page_content'].isna().sum() == 1
+
+    item.extract_locations()
+    item.extract_commodities()
+    assert [loc['name'] for loc in item.schema_doc['spatialCoverage']] == ['Nevada']
+    assert [about['name'] for about in item.schema_doc['about']] == ['gold']
+
+def test_publish_items(tmp_path, zotero_env, monkeypatch):
+    import json
+    from geoarchive.sciencebase import NI43101Process
+
+    def commit_items(zots):
+        for i, zot in enumerate(zots):
+            zot.item = {'key': f'KEY{i}', 'url': f'https://w3id.org/usgs/z/12345/KEY{i}'}
+        return zots, []
+
+    monkeypatch.setattr('geoarchive.sciencebase.zotero.commit_items', commit_items)
+
+    process = NI43101Process.__new__(NI43101Process)
+    process.__dict__.update(cache_path=str(tmp_path), zotero_library_id='12345', sb=MagicMock())
+    uploaded = []
+    process.sb.upload_files_and_upsert_item.side_effect = lambda item, filenames, scrape_file: uploaded.append(
+        (item, json.loads(open(filenames[0]).read()))
+    )
+
+    schema_doc = {
+        'name': 'Report', 'additionalType': 'Report', 'datePublished': '2024-01-01', 'numberOfPages': 1,
+        'identifier': [], 'spatialCoverage': [], 'about': []
+    }
+    assert process.publish_items([(dict(schema_doc), {'id': f'sb{i}'}, f'0000{i}') for i in range(2)]) == {}
+
+    assert [doc['url'] for item, doc in uploaded] == ['https://w3id.org/usgs/z/12345/KEY0', 'https://w3id.org/usgs/z/12345/KEY1']
+    assert [item['webLinks'][0]['uri'] for item, doc in uploaded] == [doc['url'] for item, doc in uploaded]
+    process.sb.replace_file.assert_not_called()
+    process.sb.update_item.assert_not_called()
+    assert not list(tmp_path.glob('*.json'))
+
+def test_prep_files_names_files_by_filing_id(tmp_path):
+    item = pdf_item(tmp_path, ['Page 1 text'])
+    (tmp_path / 'abc.parquet').write_bytes(b'parquet')
+    item.add_identifier({'name': 'SEDAR filing identifier', 'value': '00012345'})
+    item.prep_files()
+
+    assert item.sedar_filing_id == '00012345'
+    assert item.item_files == [str(tmp_path / '00012345.pdf'), str(tmp_path / '00012345.parquet')]
+    assert all(os.path.exists(f) for f in item.item_files)
+
+def test_built_item_pickles_without_session_or_text(tmp_path):
+    import pickle
+
+    item = pdf_item(tmp_path, ['Page 1 text'], sb=MagicMock())
+    item.parse_pdf_text()
+
+    restored = pickle.loads(pickle.dumps(item))
+    assert not hasattr(restored, 'sb') and not hasattr(restored, 'pages') and not hasattr(restored, 'full_text')
+    assert restored.schema_doc == item.schema_doc
@@ -66,4 +66,48 @@ def test_z_item_from_schema(zotero_env):
     assert zot.z_item['language'] == 'en'
     assert zot.z_item['archive'] == 'ScienceBase'
     assert zot.z_item['archiveLocation'] == 'https://www.sciencebase.gov/catalog/item/12345'
-    assert zot.z_item['tags'] == [{'tag': 'location:United States'}, {'tag': 'commodity:gold'}]
\ No newline at end of file
+    assert zot.z_item['tags'] == [{'tag': 'location:United States'}, {'tag': 'commodity:gold'}]
+
+def test_commit_items_in_batches(zotero_env):
+    from geoarchive.zotero import commit_items
+
+    zots = [Zot(library_id='12345', schema_doc=schema_doc) for _ in range(3)]
+    z = MagicMock()
+    z.create_items.side_effect = lambda items: {
+        'successful': {str(i): {'data': dict(item, version=1)} for i, item in enumerate(items)},
+        'failed': {}
+    }
+    for zot in zots:
+        zot.z = z
+
+    commit_items(zots, batch_size=2)
+
+    assert z.create_items.call_count == 2
+    z.update_item.assert_not_called()
+    assert len({zot.item['key'] for zot in zots}) == 3
+    for zot in zots:
+        assert len(zot.item['key']) == 8
+        assert zot.item['url'] == f"https://w3id.org/usgs/z/12345/{zot.item['key']}"
+
+def test_commit_items_failure(zotero_env):
+    from geoarchive.zotero import commit_items
+
+    zots = [Zot(library_id='12345', schema_doc=schema_doc) for _ in range(2)]
+    z = MagicMock()
+    z.create_items.side_effect = lambda items: {
+        'successful': {'1': {'data': dict(items[1], version=1)}},
+        'failed': {'0': {'code': 400, 'message': 'Invalid'}}
+    }
+    for zot in zots:
+        zot.z = z
+
+    # The item Zotero did create is still handed back to be published
+    created, failed = commit_items(zots)
+    assert created == [zots[1]]
+    assert [zot for zot, e in failed] == [zots[0]]
+    assert isinstance(failed[0][1], ValueError)
+
+    zots[0].z = MagicMock()
+    zots[0].z.create_items.return_value = {'successful': {}, 'failed': {'0': {'code': 400, 'message': 'Invalid'}}}
+    with pytest.raises(ValueError):
+        zots[0].commit()